@@ -2,6 +2,8 @@ import Jetson.GPIO as GPIO
 import time
 import spidev
 import os
+import ctypes
+import fcntl
 
 # GPIO.setmode(GPIO.BOARD)  # Use physical pin numbers
 # GPIO.setup(32, GPIO.IN, pull_up_down=GPIO.PUD_UP)
@@ -11,28 +13,61 @@ import os
 #     print(f"Pin state: {state}")
 #     time.sleep(1)
 
+GPIO.setmode(GPIO.BOARD)  # Use physical pin numbers
+_configured = set()  # Pins already set up as pulled-up inputs
+
+def _setup_input(pin):
+    """Configure pin as a pulled-up input once, however many objects use it"""
+    if pin not in _configured:
+        GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        _configured.add(pin)
+
+class _SpiIocTransfer(ctypes.Structure):
+    """struct spi_ioc_transfer from <linux/spi/spidev.h>"""
+    _fields_ = [
+        ("tx_buf", ctypes.c_uint64),
+        ("rx_buf", ctypes.c_uint64),
+        ("len", ctypes.c_uint32),
+        ("speed_hz", ctypes.c_uint32),
+        ("delay_usecs", ctypes.c_uint16),
+        ("bits_per_word", ctypes.c_uint8),
+        ("cs_change", ctypes.c_uint8),
+        ("tx_nbits", ctypes.c_uint8),
+        ("rx_nbits", ctypes.c_uint8),
+        ("word_delay_usecs", ctypes.c_uint8),
+        ("pad", ctypes.c_uint8),
+    ]
+
+def _spi_ioc_message(n):
+    """SPI_IOC_MESSAGE(n) ioctl request number (_IOW('k', 0, n transfers))"""
+    return (1 << 30) | ((n * ctypes.sizeof(_SpiIocTransfer)) << 16) | (ord('k') << 8)
+
+SPI_IOC_MESSAGE_2 = _spi_ioc_message(2)
+
 class Switch():
     def __init__(self, pin, callback=None):
         self.pin = pin
-        self.state = 0
-        self.prev_state = None
         self.callback = callback
-        GPIO.setmode(GPIO.BOARD)
-        GPIO.setup(self.pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        _setup_input(self.pin)
+        self.state = self.get_state()
+        
+        # Let the kernel report transitions instead of polling every frame
+        GPIO.add_event_detect(self.pin, GPIO.BOTH, callback=self._on_edge, bouncetime=20)
 
     def get_state(self):
         return GPIO.input(self.pin)
     
-    def update(self):
+    def _on_edge(self, channel):
+        """Called from the GPIO event thread on each debounced edge"""
         new_state = self.get_state()
         
-        # Check if state changed (skip on first update when prev_state is None)
-        if self.prev_state is not None and new_state != self.prev_state:
-            if self.callback is not None:
-                self.callback()
+        # Ignore edges that settled back to the state we already have
+        if new_state == self.state:
+            return
         
-        self.prev_state = new_state
         self.state = new_state
+        if self.callback is not None:
+            self.callback()
 
 class Joystick():
     def __init__(self, x_channel, y_channel, z_pin, spi_bus=0, spi_device=0):
@@ -52,8 +87,7 @@ class Joystick():
         self.state = (0, 0, 0)
         
         # Setup GPIO for button (z_pin)
-        GPIO.setmode(GPIO.BOARD)
-        GPIO.setup(self.z_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        _setup_input(self.z_pin)
         
         # Initialize SPI for MCP3008
         # Check if SPI device exists
@@ -82,32 +116,53 @@ class Joystick():
         self.spi.max_speed_hz = 1000000  # 1 MHz
         self.spi.mode = 0  # SPI Mode 0
         self.spi.bits_per_word = 8
+        
+        # Preallocate the SPI message used by _read_adc_pair so polling
+        # doesn't build new buffers and transfer structs on every sample
+        self._tx = (ctypes.c_uint8 * 6)()
+        self._rx = (ctypes.c_uint8 * 6)()
+        self._xfers = (_SpiIocTransfer * 2)()
+        for i, xfer in enumerate(self._xfers):
+            xfer.tx_buf = ctypes.addressof(self._tx) + 3 * i
+            xfer.rx_buf = ctypes.addressof(self._rx) + 3 * i
+            xfer.len = 3
+            xfer.speed_hz = self.spi.max_speed_hz
+            xfer.bits_per_word = 8
+        self._xfers[0].cs_change = 1  # Deselect between commands to start the second conversion
     
-    def _read_adc(self, channel):
+    def _read_adc_pair(self, channel_a, channel_b):
         """
-        Read analog value from MCP3008 ADC channel
+        Read two MCP3008 channels in a single SPI message
+        
+        The MCP3008 only starts a new conversion after CS goes high, so the
+        two 3-byte commands are queued as separate transfers in one
+        SPI_IOC_MESSAGE with cs_change set on the first. This costs one
+        ioctl instead of two back-to-back xfer2 calls.
         
         Args:
-            channel: ADC channel number (0-7)
+            channel_a: First ADC channel number (0-7)
+            channel_b: Second ADC channel number (0-7)
             
         Returns:
-            Integer value from 0-1023 (10-bit ADC)
+            Tuple of integer values from 0-1023 (10-bit ADC)
         """
         # MCP3008 command format:
         # Start bit (1) + Single/Diff (1 for single-ended) + Channel (3 bits)
         # Channel 0: 0b11000 = 0x18
         # Channel 1: 0b11001 = 0x19, etc.
-        command = 0x18 | (channel & 0x07)
+        # Each transfer is the command byte + 2 dummy bytes for the response
+        tx = self._tx
+        tx[0] = 0x18 | (channel_a & 0x07)
+        tx[3] = 0x18 | (channel_b & 0x07)
         
-        # Send SPI transaction: command byte + 2 dummy bytes for response
-        response = self.spi.xfer2([command, 0x00, 0x00])
+        fcntl.ioctl(self.spi.fileno(), SPI_IOC_MESSAGE_2, self._xfers)
         
-        # Extract 10-bit value from response
+        # Extract 10-bit values from each 3-byte response
         # Response format: [ignored, high_byte, low_byte]
         # High byte: bits 9-2, Low byte: bits 1-0 (in upper 2 bits)
-        adc_value = ((response[1] & 0x03) << 8) | response[2]
-        
-        return adc_value
+        rx = self._rx
+        return (((rx[1] & 0x03) << 8) | rx[2],
+                ((rx[4] & 0x03) << 8) | rx[5])
     
     def get_state(self):
         """
@@ -119,8 +174,7 @@ class Joystick():
             - y_value: 0-1023 (analog Y-axis position)
             - button_state: 0 or 1 (button pressed/released)
         """
-        x_value = self._read_adc(self.x_channel)
-        y_value = self._read_adc(self.y_channel)
+        x_value, y_value = self._read_adc_pair(self.x_channel, self.y_channel)
         button_state = GPIO.input(self.z_pin)
         return (x_value, y_value, button_state)
     
@@ -133,6 +187,7 @@ class Joystick():
         if hasattr(self, 'spi'):
             self.spi.close()
         GPIO.cleanup(self.z_pin)
+        _configured.discard(self.z_pin)
 
 
 if __name__ == "__main__":
@@ -142,7 +197,5 @@ if __name__ == "__main__":
 
     while True:
         joystick.update()
-        trigger_switch.update()
-        cam_vid_switch.update()
         time.sleep(0.1)
         print(f"Joystick: {joystick.state}, Switch: {trigger_switch.state} , Camera/Video Switch: {cam_vid_switch.state}")
\ No newline at end of file
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """Digital camera - captures photos and videos to SD card."""
 
-import os, sys, subprocess, time
+import asyncio, concurrent.futures, os, re, sys, subprocess, time, traceback
 
 if 'DISPLAY' not in os.environ:
     os.environ['DISPLAY'] = ':0.0'
@@ -13,19 +13,58 @@ from GPIO_interface import Switch
 
 # Config
 SCREEN_WIDTH, SCREEN_HEIGHT = 570, 320
+SENSOR_WIDTH, SENSOR_HEIGHT = 640, 480
 OVERLAY_FONT = cv2.FONT_HERSHEY_SIMPLEX
+CAPTURE_QUEUE_LENGTH = 4  # frames the capture queue and appsink each hold while the loop is busy
+RECORD_QUEUE_LENGTH = 64  # frames buffered for the encoder (~60 MB at 640x480) before any are dropped
+
+# GStreamer pipelines - capture from V4L2 at sensor resolution, encode on the Jetson's NVENC block.
+# The queue puts a streaming thread between the driver and the converter so mmap'd
+# buffers keep being filled while Python is busy; the appsink's depth is set in open_capture.
+CAPTURE_PIPELINE = ("v4l2src device=/dev/video0 io-mode=mmap ! "
+                    f"video/x-raw,width={SENSOR_WIDTH},height={SENSOR_HEIGHT} ! "
+                    f"queue max-size-buffers={CAPTURE_QUEUE_LENGTH} ! "
+                    "videoconvert ! video/x-raw,format=BGR ! "
+                    "appsink drop=true sync=false")
+RECORD_PIPELINE = ("appsrc ! videoconvert ! video/x-raw,format=I420 ! nvvidconv ! "
+                   "nvv4l2h264enc bitrate=8000000 ! h264parse ! qtmux ! filesink location=\"{path}\"")
 
 # Global state
 current_mode = 0  # 0=cam, 1=video
+cap = None
 last_frame = None
 is_recording = False
-video_writer = None
-video_filepath = None
 camera_fps = 10.0
-recording_start_time = None
-recording_frame_count = 0
+frame_queue = None  # frames waiting for the encoder while recording
+dropped_frames = 0  # frames the encoder couldn't keep up with this recording
+record_task = None
+event_loop = None  # set while camera_loop runs; GPIO callbacks hop onto it
+trigger_lock = None
+_sd_cache = None  # resolved SD mount point
+_next_index = {}  # (dcim_path, prefix, ext) -> next file number
+
+def has_gstreamer():
+    """Check whether OpenCV was built with GStreamer support."""
+    for line in cv2.getBuildInformation().split('\n'):
+        if "GStreamer" in line:
+            return "YES" in line
+    return False
+
+HAS_GSTREAMER = has_gstreamer()
+USE_OPENCL = cv2.ocl.haveOpenCL()  # run the preview resize/composite through UMat if so
 
-def get_sd_path():
+def open_capture():
+    """Open the camera pipeline at sensor resolution."""
+    capture = cv2.VideoCapture(CAPTURE_PIPELINE, cv2.CAP_GSTREAMER)
+    # OpenCV resets appsink max-buffers to this property (default 1) on open, so a
+    # max-buffers in the pipeline string is ignored. A deeper queue absorbs stalls
+    # (save, encoder hiccup) without losing frames, at the cost of the viewfinder
+    # lagging by up to CAPTURE_QUEUE_LENGTH frames until the loop catches up, since
+    # read() returns the oldest queued frame.
+    capture.set(cv2.CAP_PROP_GSTREAMER_QUEUE_LENGTH, CAPTURE_QUEUE_LENGTH)
+    return capture
+
+def mount_sd():
     """Mount SD card and return path, or None."""
     try:
         result = subprocess.run(["udisksctl", "mount", "-b", "/dev/sda1"],
@@ -43,69 +82,272 @@ def get_sd_path():
         pass
     return None
 
-def get_next_filename(dcim_path, prefix, ext):
-    """Get next available numbered filename with prefix."""
-    highest = 0
-    for f in os.listdir(dcim_path):
-        if f.startswith(prefix) and f.endswith(ext):
-            num_part = f[len(prefix):-len(ext)]
-            if num_part.isdigit():
-                highest = max(highest, int(num_part))
-    return os.path.join(dcim_path, f"{prefix}{highest + 1:03d}{ext}")
+def get_sd_path(refresh=False):
+    """Return cached SD mount path, mounting the card on first use, or None."""
+    global _sd_cache
+    if refresh or not _sd_cache or not os.path.ismount(_sd_cache):
+        _sd_cache = mount_sd()
+    return _sd_cache
 
-def trigger_callback():
-    """Handle trigger button press."""
-    global last_frame, is_recording, video_writer, video_filepath
-    global recording_start_time, recording_frame_count, camera_fps
-    
-    if last_frame is None:
-        return
-    
-    mount_path = get_sd_path()
+def get_dcim_path(refresh=False):
+    """Return DCIM directory on the SD card, creating it if needed, or None."""
+    mount_path = get_sd_path(refresh)
     if mount_path is None:
+        return None
+    dcim_path = os.path.join(mount_path, "DCIM")
+    try:
+        os.makedirs(dcim_path, exist_ok=True)
+    except OSError:
+        return None
+    return dcim_path
+
+def sync_file(filepath):
+    """Flush one file's data to the SD card instead of every filesystem."""
+    with open(filepath, 'rb') as f:
+        os.fdatasync(f.fileno())
+
+def get_next_filename(dcim_path, prefix, ext):
+    """Get next available numbered filename with prefix, scanning the directory only once."""
+    key = (dcim_path, prefix, ext)
+    while True:
+        if key not in _next_index:
+            pattern = re.compile(rf"{re.escape(prefix)}(\d+){re.escape(ext)}$")
+            with os.scandir(dcim_path) as entries:
+                matches = (pattern.match(entry.name) for entry in entries)
+                _next_index[key] = max((int(m.group(1)) for m in matches if m), default=0) + 1
+        index = _next_index[key]
+        _next_index[key] = index + 1
+        filepath = os.path.join(dcim_path, f"{prefix}{index:03d}{ext}")
+        
+        # A swapped card with the same label mounts at the same path, so the cached
+        # count can be stale; never hand out a name that's taken, rescan instead
+        if not os.path.exists(filepath):
+            return filepath
+        del _next_index[key]
+
+def save_photo(frame):
+    """Write frame to the next img_ file on the SD card (blocking)."""
+    dcim_path = get_dcim_path()
+    if dcim_path is None:
         print("No SD card")
         return
     
-    dcim_path = os.path.join(mount_path, "DCIM")
-    os.makedirs(dcim_path, exist_ok=True)
-    
-    if current_mode == 0:  # Photo mode
+    filepath = get_next_filename(dcim_path, "img_", ".jpg")
+    if not cv2.imwrite(filepath, frame):
+        # Cached mount and numbering may be stale (card removed/remounted), re-resolve once
+        _next_index.clear()
+        dcim_path = get_dcim_path(refresh=True)
+        if dcim_path is None:
+            print("No SD card")
+            return
         filepath = get_next_filename(dcim_path, "img_", ".jpg")
-        cv2.imwrite(filepath, last_frame)
-        os.sync()
-        print(f"Saved: {filepath}")
-    else:  # Video mode
-        if not is_recording:
-            video_filepath = get_next_filename(dcim_path, "mov_", ".mp4")
-            h, w = last_frame.shape[:2]
-            video_writer = cv2.VideoWriter(video_filepath, 
-                cv2.VideoWriter_fourcc(*'mp4v'), camera_fps, (w, h))
-            is_recording = True
-            recording_start_time = time.time()
-            recording_frame_count = 0
-            print(f"Recording: {video_filepath}")
+        if not cv2.imwrite(filepath, frame):
+            print(f"Error: Could not save {filepath}")
+            return
+    sync_file(filepath)
+    print(f"Saved: {filepath}")
+
+def open_recording(frame_size):
+    """Open an H.264 writer on the next mov_ file (blocking), or return (None, None)."""
+    for refresh in (False, True):
+        dcim_path = get_dcim_path(refresh)
+        if dcim_path is None:
+            print("No SD card")
+            return None, None
+        
+        filepath = get_next_filename(dcim_path, "mov_", ".mp4")
+        writer = cv2.VideoWriter(RECORD_PIPELINE.format(path=filepath),
+            cv2.CAP_GSTREAMER, 0, camera_fps, frame_size)
+        if writer.isOpened():
+            print(f"Recording: {filepath}")
+            return writer, filepath
+        
+        # Cached mount and numbering may be stale (card removed/remounted), re-resolve
+        # once; clearing also gives back the file number this attempt used up
+        _next_index.clear()
+    
+    print("Error: Could not open H.264 encoder")
+    return None, None
+
+async def record(writer, filepath, queue):
+    """Encode queued frames until None arrives, then close the file."""
+    global camera_fps
+    loop = asyncio.get_running_loop()
+    # A single encoder thread keeps write/release ordered even if we're cancelled mid-write
+    encoder = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    start = time.time()
+    frames = 0
+    
+    try:
+        while (frame := await queue.get()) is not None:
+            await loop.run_in_executor(encoder, writer.write, frame)
+            frames += 1
+        await loop.run_in_executor(encoder, writer.release)
+        await loop.run_in_executor(encoder, sync_file, filepath)
+    except asyncio.CancelledError:
+        # Shutdown (Ctrl-C) cancelled us: finish the file synchronously so queued
+        # frames are kept and the writer is still released and synced
+        while not queue.empty():
+            frame = queue.get_nowait()
+            if frame is not None:
+                encoder.submit(writer.write, frame)
+                frames += 1
+        encoder.submit(writer.release)
+        encoder.submit(sync_file, filepath).result()
+        raise
+    finally:
+        encoder.shutdown()
+        elapsed = time.time() - start
+        if elapsed > 0 and frames > 0:
+            # Dropped frames were still captured, so count them towards the capture rate
+            camera_fps = (frames + dropped_frames) / elapsed
+            print(f"Stopped: {frames} frames, {elapsed:.1f}s, {camera_fps:.1f} fps")
+        if dropped_frames:
+            print(f"Warning: dropped {dropped_frames} frames, video will play back short")
+
+async def stop_recording():
+    """Flush queued frames and close the current recording."""
+    global is_recording, frame_queue, record_task
+    is_recording = False
+    await frame_queue.put(None)
+    await record_task
+    frame_queue = record_task = None
+
+async def handle_trigger():
+    """Save a photo or start/stop recording without stalling the preview."""
+    global is_recording, frame_queue, record_task, dropped_frames
+    
+    if last_frame is None:
+        return
+    
+    loop = asyncio.get_running_loop()
+    async with trigger_lock:  # one press at a time, so filenames can't collide
+        if current_mode == 0:  # Photo mode
+            # Frames are never modified after capture, so the one on screen can be saved as is
+            await loop.run_in_executor(None, save_photo, last_frame)
+        elif not is_recording:  # Video mode
+            writer, filepath = await loop.run_in_executor(None, open_recording,
+                                                          (SENSOR_WIDTH, SENSOR_HEIGHT))
+            if writer is not None:
+                frame_queue = asyncio.Queue(maxsize=RECORD_QUEUE_LENGTH)
+                dropped_frames = 0
+                record_task = asyncio.create_task(record(writer, filepath, frame_queue))
+                is_recording = True
         else:
-            if video_writer:
-                video_writer.release()
-                video_writer = None
-                os.sync()
-                elapsed = time.time() - recording_start_time
-                if elapsed > 0 and recording_frame_count > 0:
-                    camera_fps = recording_frame_count / elapsed
-                    print(f"Stopped: {recording_frame_count} frames, {elapsed:.1f}s, {camera_fps:.1f} fps")
-            is_recording = False
+            await stop_recording()
+
+def report_trigger_error(future):
+    """Print the traceback of a failed handle_trigger, which would otherwise be lost."""
+    if not future.cancelled() and future.exception() is not None:
+        exc = future.exception()
+        traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+def trigger_callback():
+    """Handle trigger button press (called from the GPIO event thread)."""
+    if event_loop is not None:
+        future = asyncio.run_coroutine_threadsafe(handle_trigger(), event_loop)
+        future.add_done_callback(report_trigger_error)
 
 def rebuild_overlay(overlay, elements):
-    """Redraw overlay text."""
+    """Redraw overlay text and return (bbox, rgb, mask) for compositing."""
     overlay[:] = 0
+    x0, y0, x1, y1 = overlay.shape[1], overlay.shape[0], 0, 0
     for elem in elements.values():
         cv2.putText(overlay, elem["text"], elem["pos"], OVERLAY_FONT, 1.0, (255,255,255), 2)
-    overlay[np.any(overlay[:,:,:3] > 0, axis=2), 3] = 255
+        (w, h), baseline = cv2.getTextSize(elem["text"], OVERLAY_FONT, 1.0, 2)
+        x, y = elem["pos"]
+        x0, y0 = min(x0, x - 2), min(y0, y - h - 2)
+        x1, y1 = max(x1, x + w + 2), max(y1, y + baseline + 2)
+    
+    # Only the text's bounding box needs compositing, so cache it once per rebuild.
+    # Text is drawn white and fully opaque, so one channel gives the alpha mask
+    # and a masked copy is an exact alpha blend.
+    x0, y0 = max(x0, 0), max(y0, 0)
+    x1, y1 = min(x1, overlay.shape[1]), min(y1, overlay.shape[0])
+    rgb = overlay[y0:y1, x0:x1].copy()
+    mask = (rgb[:, :, 0] > 0).astype(np.uint8)
+    if USE_OPENCL:
+        # Upload once per rebuild rather than every frame
+        rgb, mask = cv2.UMat(rgb), cv2.UMat(mask)
+    return (x0, y0, x1, y1), rgb, mask
+
+def blend_overlay(frame, blend):
+    """Composite the cached overlay box into frame (ndarray or UMat) in place."""
+    (x0, y0, x1, y1), rgb, mask = blend
+    if isinstance(frame, cv2.UMat):
+        roi = cv2.UMat(frame, (y0, y1), (x0, x1))
+    else:
+        roi = frame[y0:y1, x0:x1]
+    cv2.copyTo(rgb, mask, roi)
+
+async def camera_loop(mode_switch):
+    """Capture, record and display frames until 'q' or the camera stops."""
+    global event_loop, trigger_lock, current_mode, last_frame, dropped_frames
+    
+    event_loop = asyncio.get_running_loop()
+    trigger_lock = asyncio.Lock()
+    
+    # Setup overlay
+    overlay = np.zeros((SCREEN_HEIGHT, SCREEN_WIDTH, 3), dtype=np.uint8)
+    overlay_elements = {"mode": {"text": "cam", "pos": (10, SCREEN_HEIGHT - 10)}}
+    overlay_blend = None
+    prev_mode = None
+    
+    read = event_loop.run_in_executor(None, cap.read)
+    try:
+        while True:
+            if mode_switch.state != prev_mode:
+                current_mode = mode_switch.state
+                overlay_elements["mode"]["text"] = "cam" if current_mode == 0 else "video"
+                overlay_blend = rebuild_overlay(overlay, overlay_elements)
+                prev_mode = mode_switch.state
+            
+            ret, frame = await read
+            read = None
+            if not ret:
+                break
+            
+            # Capture the next frame while this one is recorded and shown
+            read = event_loop.run_in_executor(None, cap.read)
+            last_frame = frame  # read() returns a fresh buffer, no copy needed
+            
+            if is_recording:
+                try:
+                    frame_queue.put_nowait(frame)
+                except asyncio.QueueFull:
+                    # Encoder is far behind; drop rather than stall the preview, but keep count
+                    dropped_frames += 1
+            
+            # Display a resized copy with overlay (on the GPU through the T-API when OpenCL
+            # is available). Capture is pinned to sensor size, so the resize always runs and
+            # frame itself stays untouched for saving and recording.
+            preview = cv2.resize(cv2.UMat(frame) if USE_OPENCL else frame,
+                                 (SCREEN_WIDTH, SCREEN_HEIGHT))
+            blend_overlay(preview, overlay_blend)
+            
+            cv2.imshow('cam', preview)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+    
+    finally:
+        if read is not None:
+            try:
+                await read
+            except asyncio.CancelledError:
+                pass  # Ctrl-C cancels the pending read along with us; still close the recording
+        async with trigger_lock:  # let an in-flight save or start finish
+            if is_recording:
+                await asyncio.shield(stop_recording())
+        event_loop = None
 
 def main():
-    global camera_fps, current_mode, last_frame, recording_frame_count
+    global cap, camera_fps
     
-    cap = cv2.VideoCapture(0)
+    if not HAS_GSTREAMER:
+        print("Error: OpenCV was built without GStreamer support")
+        sys.exit(1)
+    
+    cap = open_capture()
     if not cap.isOpened():
         print("Error: Could not open camera")
         sys.exit(1)
@@ -129,52 +371,19 @@ def main():
     mode_switch = Switch(31)
     trigger = Switch(32, callback=trigger_callback)
     
-    # Setup overlay
-    overlay = np.zeros((SCREEN_HEIGHT, SCREEN_WIDTH, 4), dtype=np.uint8)
-    overlay_elements = {"mode": {"text": "cam", "pos": (10, SCREEN_HEIGHT - 10)}}
-    prev_mode = None
+    # Resolve the SD card up front so the first shutter press doesn't pay for it
+    if get_sd_path() is None:
+        print("No SD card")
     
     print("Running. Press 'q' to quit.")
     
     try:
-        while True:
-            mode_switch.update()
-            trigger.update()
-            
-            if mode_switch.state != prev_mode:
-                current_mode = mode_switch.state
-                overlay_elements["mode"]["text"] = "cam" if current_mode == 0 else "video"
-                rebuild_overlay(overlay, overlay_elements)
-                prev_mode = mode_switch.state
-            
-            ret, frame = cap.read()
-            if not ret:
-                break
-            
-            last_frame = frame.copy()
-            
-            if is_recording and video_writer:
-                video_writer.write(frame)
-                recording_frame_count += 1
-            
-            # Display with overlay
-            frame = cv2.resize(frame, (SCREEN_WIDTH, SCREEN_HEIGHT))
-            alpha = overlay[:,:,3:4].astype(np.float32) / 255.0
-            alpha3 = np.repeat(alpha, 3, axis=2)
-            frame = (frame.astype(np.float32) * (1 - alpha3) + 
-                     overlay[:,:,:3].astype(np.float32) * alpha3).astype(np.uint8)
-            
-            cv2.imshow('cam', frame)
-            if cv2.waitKey(1) & 0xFF == ord('q'):
-                break
+        asyncio.run(camera_loop(mode_switch))
     
     except KeyboardInterrupt:
         pass
     
     finally:
-        if video_writer:
-            video_writer.release()
-            os.sync()
         cap.release()
         cv2.destroyAllWindows()
         GPIO.cleanup()